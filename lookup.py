@@ -0,0 +1,375 @@
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from aiohttp import web
+
+from main import CHUNK_SIZE, NDJSON_FILENAME, parcel_rings
+
+INDEX_FILENAME = 'buildings_index.npz'
+INDEX_CELL_DEG = 0.001  # ~100 m grid cells for the spatial index
+QUERY_BATCH_SIZE = 200_000  # points per vectorized step (bounds memory use)
+INDEX_FORMAT = 2  # bump when the arrays stored in the index file change
+
+# Cell keys are packed into a single int64: (row + OFFSET) * WIDTH + (col + OFFSET)
+_KEY_OFFSET = 2 ** 20
+_KEY_WIDTH = 2 ** 21
+
+FILTER_RE = re.compile(
+    r'contains\(\s*parcel\s*,\s*POINT\(\s*([-+0-9.eE]+)\s+([-+0-9.eE]+)\s*\)\s*\)'
+)
+
+
+def _cell_keys(lats, lons, cell_deg):
+    rows = np.floor(np.asarray(lats, dtype=np.float64) / cell_deg).astype(np.int64)
+    cols = np.floor(np.asarray(lons, dtype=np.float64) / cell_deg).astype(np.int64)
+    return (rows + _KEY_OFFSET) * _KEY_WIDTH + (cols + _KEY_OFFSET)
+
+
+def iter_buildings(filename: str):
+    """
+    Yield unique buildings (by id) from a harvested ND-JSON file.
+    """
+    seen = set()
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                building = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            b_id = building.get('id')
+            if b_id is None or b_id in seen:
+                continue
+            seen.add(b_id)
+            yield building
+
+
+class BuildingIndex:
+    """
+    Grid-bucketed spatial index of parcel polygons.
+
+    Polygon edges are stored as flat numpy arrays so that point-in-polygon
+    tests for many points run vectorized (even-odd rule over all rings).
+    Each building's compact JSON is kept too, so the index can answer API
+    requests without the harvest file.
+    """
+
+    def __init__(self, ids, bboxes, edges, edge_offsets, cell_keys, cell_offsets, cell_buildings, cell_deg,
+                 records, record_offsets):
+        self.ids = ids                        # (n,) building IDs as strings
+        self.bboxes = bboxes                  # (n, 4) min_lon, min_lat, max_lon, max_lat
+        self.edges = edges                    # (e, 4) x0, y0, x1, y1
+        self.edge_offsets = edge_offsets      # (n + 1,) edges of building i are [off[i], off[i+1])
+        self.cell_keys = cell_keys            # (c,) sorted grid cell keys
+        self.cell_offsets = cell_offsets      # (c + 1,) buildings of cell j are cell_buildings[off[j]:off[j+1]]
+        self.cell_buildings = cell_buildings  # building positions, grouped by cell
+        self.cell_deg = cell_deg
+        self.records = records                # UTF-8 JSON of all buildings, concatenated (uint8)
+        self.record_offsets = record_offsets  # (n + 1,) JSON of building i is records[off[i]:off[i+1]]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, buildings, cell_deg=INDEX_CELL_DEG):
+        """
+        Build the index from an iterable of building dicts (as stored in the ND-JSON harvest).
+        Buildings without a usable parcel polygon are skipped.
+        """
+        ids, bboxes, edges, edge_offsets = [], [], [], [0]
+        records, record_offsets = [], [0]
+        cell_pairs = []  # (cell key, building position)
+
+        for building in buildings:
+            rings = [ring for ring in parcel_rings(building) if len(ring) >= 3]
+            if not rings:
+                continue
+            pos = len(ids)
+            ids.append(str(building['id']))
+            record = json.dumps(building, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            records.append(record)
+            record_offsets.append(record_offsets[-1] + len(record))
+
+            n_edges = 0
+            for ring in rings:
+                pts = np.asarray(ring, dtype=np.float64)
+                if not np.array_equal(pts[0], pts[-1]):
+                    pts = np.vstack([pts, pts[:1]])
+                edges.append(np.hstack([pts[:-1], pts[1:]]))
+                n_edges += len(pts) - 1
+            edge_offsets.append(edge_offsets[-1] + n_edges)
+
+            all_pts = np.vstack([np.asarray(ring, dtype=np.float64) for ring in rings])
+            min_lon, min_lat = all_pts.min(axis=0)
+            max_lon, max_lat = all_pts.max(axis=0)
+            bboxes.append((min_lon, min_lat, max_lon, max_lat))
+
+            row_min, row_max = int(np.floor(min_lat / cell_deg)), int(np.floor(max_lat / cell_deg))
+            col_min, col_max = int(np.floor(min_lon / cell_deg)), int(np.floor(max_lon / cell_deg))
+            for row in range(row_min, row_max + 1):
+                for col in range(col_min, col_max + 1):
+                    key = (row + _KEY_OFFSET) * _KEY_WIDTH + (col + _KEY_OFFSET)
+                    cell_pairs.append((key, pos))
+
+        if cell_pairs:
+            pairs = np.asarray(cell_pairs, dtype=np.int64)
+            pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+            cell_keys, starts = np.unique(pairs[:, 0], return_index=True)
+            cell_offsets = np.append(starts, len(pairs)).astype(np.int64)
+            cell_buildings = pairs[:, 1].copy()
+        else:
+            cell_keys = np.empty(0, dtype=np.int64)
+            cell_offsets = np.zeros(1, dtype=np.int64)
+            cell_buildings = np.empty(0, dtype=np.int64)
+
+        return cls(
+            ids=np.asarray(ids, dtype=str),
+            bboxes=np.asarray(bboxes, dtype=np.float64).reshape(-1, 4),
+            edges=np.vstack(edges) if edges else np.empty((0, 4), dtype=np.float64),
+            edge_offsets=np.asarray(edge_offsets, dtype=np.int64),
+            cell_keys=cell_keys,
+            cell_offsets=cell_offsets,
+            cell_buildings=cell_buildings,
+            cell_deg=cell_deg,
+            records=np.frombuffer(b''.join(records), dtype=np.uint8),
+            record_offsets=np.asarray(record_offsets, dtype=np.int64),
+        )
+
+    def save(self, filename: str):
+        np.savez_compressed(
+            filename,
+            ids=self.ids,
+            bboxes=self.bboxes,
+            edges=self.edges,
+            edge_offsets=self.edge_offsets,
+            cell_keys=self.cell_keys,
+            cell_offsets=self.cell_offsets,
+            cell_buildings=self.cell_buildings,
+            cell_deg=np.float64(self.cell_deg),
+            records=self.records,
+            record_offsets=self.record_offsets,
+            format=np.int64(INDEX_FORMAT),
+        )
+
+    @classmethod
+    def load(cls, filename: str):
+        with np.load(filename, allow_pickle=False) as data:
+            if 'format' not in data.files or int(data['format']) != INDEX_FORMAT:
+                raise ValueError(f"{filename} was built by an older version; rebuild it with `python lookup.py build`")
+            return cls(
+                ids=data['ids'],
+                bboxes=data['bboxes'],
+                edges=data['edges'],
+                edge_offsets=data['edge_offsets'],
+                cell_keys=data['cell_keys'],
+                cell_offsets=data['cell_offsets'],
+                cell_buildings=data['cell_buildings'],
+                cell_deg=float(data['cell_deg']),
+                records=data['records'],
+                record_offsets=data['record_offsets'],
+            )
+
+    def query(self, lats, lons):
+        """
+        Vectorized contains(parcel, POINT(lon lat)) for many points.
+
+        Returns two int arrays (point_positions, building_positions): one entry per
+        (point, building) match, sorted by point position. Use self.ids[building_positions]
+        for the building IDs.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        point_parts, building_parts = [], []
+        for start in range(0, len(lats), QUERY_BATCH_SIZE):
+            stop = start + QUERY_BATCH_SIZE
+            p, b = self._query_block(lats[start:stop], lons[start:stop])
+            point_parts.append(p + start)
+            building_parts.append(b)
+        if not point_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(point_parts), np.concatenate(building_parts)
+
+    def _query_block(self, lats, lons):
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        if len(self.cell_keys) == 0 or len(lats) == 0:
+            return empty
+
+        # 1) Grid lookup: candidate buildings of each point's cell
+        valid = np.isfinite(lats) & np.isfinite(lons)
+        keys = _cell_keys(np.where(valid, lats, 0.0), np.where(valid, lons, 0.0), self.cell_deg)
+        slot = np.searchsorted(self.cell_keys, keys)
+        slot_clipped = np.minimum(slot, len(self.cell_keys) - 1)
+        hit = valid & (self.cell_keys[slot_clipped] == keys)
+        starts = np.where(hit, self.cell_offsets[slot_clipped], 0)
+        counts = np.where(hit, self.cell_offsets[slot_clipped + 1] - starts, 0)
+        if counts.sum() == 0:
+            return empty
+
+        pair_point = np.repeat(np.arange(len(lats)), counts)
+        pair_rank = np.arange(len(pair_point)) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_building = self.cell_buildings[np.repeat(starts, counts) + pair_rank]
+
+        # 2) Bounding-box filter
+        px, py = lons[pair_point], lats[pair_point]
+        bb = self.bboxes[pair_building]
+        inside_bb = (px >= bb[:, 0]) & (px <= bb[:, 2]) & (py >= bb[:, 1]) & (py <= bb[:, 3])
+        pair_point, pair_building = pair_point[inside_bb], pair_building[inside_bb]
+        if len(pair_point) == 0:
+            return empty
+
+        # 3) Even-odd ray casting over every edge of each candidate pair
+        edge_start = self.edge_offsets[pair_building]
+        edge_count = self.edge_offsets[pair_building + 1] - edge_start
+        edge_pair = np.repeat(np.arange(len(pair_point)), edge_count)
+        edge_rank = np.arange(len(edge_pair)) - np.repeat(np.cumsum(edge_count) - edge_count, edge_count)
+        e = self.edges[np.repeat(edge_start, edge_count) + edge_rank]
+        x, y = lons[pair_point][edge_pair], lats[pair_point][edge_pair]
+        x0, y0, x1, y1 = e[:, 0], e[:, 1], e[:, 2], e[:, 3]
+
+        straddles = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        crossings = straddles & (x < x_cross)
+        inside = np.bincount(edge_pair, weights=crossings, minlength=len(pair_point)) % 2 == 1
+
+        return pair_point[inside], pair_building[inside]
+
+    def building_json(self, pos):
+        """
+        Compact JSON text of the building at position pos, as harvested.
+        """
+        start, stop = self.record_offsets[pos], self.record_offsets[pos + 1]
+        return self.records[start:stop].tobytes().decode('utf-8')
+
+    def lookup_ids(self, lats, lons):
+        """
+        Return a list with, for each point, the list of building IDs whose parcel contains it.
+        """
+        point_pos, building_pos = self.query(lats, lons)
+        result = [[] for _ in range(len(lats))]
+        for p, b_id in zip(point_pos.tolist(), self.ids[building_pos].tolist()):
+            result[p].append(b_id)
+        return result
+
+
+def build_index(source: str = NDJSON_FILENAME, filename: str = INDEX_FILENAME):
+    """
+    Build the spatial index from the ND-JSON harvest and persist it.
+    """
+    index = BuildingIndex.build(iter_buildings(source))
+    index.save(filename)
+    print(f"Indexed {len(index)} buildings from {source} into {filename}")
+    return index
+
+
+def get_index(source: str = NDJSON_FILENAME, filename: str = INDEX_FILENAME):
+    """
+    Load the persisted index, (re)building it if it is missing, outdated or older than the harvest.
+    The harvest is only needed to build; an existing index works without it.
+    """
+    if not os.path.exists(source):
+        if not os.path.exists(filename):
+            raise FileNotFoundError(f"Neither the index {filename} nor the harvest {source} exists")
+        return BuildingIndex.load(filename)
+
+    if os.path.exists(filename) and os.path.getmtime(filename) >= os.path.getmtime(source):
+        try:
+            return BuildingIndex.load(filename)
+        except ValueError as e:
+            print(f"{e}; rebuilding.")
+    return build_index(source, filename)
+
+
+def annotate_csv(index, input_csv: str, output_csv: str, lat_col: str = 'Lat', lon_col: str = 'Long'):
+    """
+    Copy input_csv to output_csv with an extra 'Building IDs' column
+    (';'-separated IDs of all buildings whose parcel contains the point).
+    """
+    total_rows = 0
+    matched_rows = 0
+    first_chunk = True
+    for df_chunk in pd.read_csv(input_csv, chunksize=CHUNK_SIZE):
+        lats = pd.to_numeric(df_chunk[lat_col], errors='coerce').to_numpy()
+        lons = pd.to_numeric(df_chunk[lon_col], errors='coerce').to_numpy()
+        ids = index.lookup_ids(lats, lons)
+        df_chunk['Building IDs'] = [';'.join(b_ids) for b_ids in ids]
+
+        total_rows += len(df_chunk)
+        matched_rows += sum(1 for b_ids in ids if b_ids)
+        df_chunk.to_csv(output_csv, mode='w' if first_chunk else 'a', header=first_chunk, index=False)
+        first_chunk = False
+
+    print(f"Annotated {total_rows} rows ({matched_rows} inside a known parcel) into {output_csv}")
+
+
+def make_app(index):
+    """
+    aiohttp app answering GET /post-services/buildings?$filter=contains(parcel, POINT(lon lat))
+    from the local index, in the same {"value": [...]} shape as the live API.
+    """
+    async def buildings(request):
+        match = FILTER_RE.search(request.query.get('$filter', ''))
+        try:
+            lon, lat = float(match.group(1)), float(match.group(2))
+        except (AttributeError, ValueError):
+            # No match, or numbers like "e" / "1..5" that the pattern lets through
+            return web.json_response(
+                {'error': "Only $filter=contains(parcel, POINT(lon lat)) is supported"}, status=400
+            )
+        try:
+            top = int(request.query.get('$top', '20'))
+        except ValueError:
+            top = -1
+        if top < 0:
+            return web.json_response({'error': 'Invalid $top'}, status=400)
+
+        _, building_pos = index.query([lat], [lon])
+        # The stored records are already JSON, so they are spliced in as-is
+        value = ','.join(index.building_json(pos) for pos in building_pos[:top].tolist())
+        return web.Response(text='{"value":[' + value + ']}', content_type='application/json')
+
+    app = web.Application()
+    app.router.add_get('/post-services/buildings', buildings)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline point-to-building lookup over the harvested buildings.")
+    parser.add_argument('--source', default=NDJSON_FILENAME, help='Harvested ND-JSON buildings file.')
+    parser.add_argument('--index', default=INDEX_FILENAME, help='Persisted spatial index file.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('build', help='(Re)build the spatial index from the harvest.')
+
+    annotate_parser = subparsers.add_parser('annotate', help='Add a "Building IDs" column to a CSV.')
+    annotate_parser.add_argument('input_csv')
+    annotate_parser.add_argument('output_csv')
+    annotate_parser.add_argument('--lat-col', default='Lat')
+    annotate_parser.add_argument('--lon-col', default='Long')
+
+    serve_parser = subparsers.add_parser('serve', help='Serve /post-services/buildings locally.')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if not os.path.exists(args.source):
+            parser.error(f"Harvest file {args.source} not found")
+        build_index(args.source, args.index)
+    else:
+        try:
+            index = get_index(args.source, args.index)
+        except (FileNotFoundError, ValueError) as e:
+            parser.error(str(e))
+
+        if args.command == 'annotate':
+            annotate_csv(index, args.input_csv, args.output_csv, lat_col=args.lat_col, lon_col=args.lon_col)
+        elif args.command == 'serve':
+            web.run_app(make_app(index), host=args.host, port=args.port)
@@ -7,6 +7,9 @@ import ssl
 from urllib.parse import urlencode
 from tqdm.asyncio import tqdm_asyncio
 import argparse
+import math
+import re
+from collections import deque
 
 CHUNK_SIZE = 50_000
 MAX_FAILURES = 10
@@ -22,13 +25,159 @@ HEADERS = {
 
 PROGRESS_FILE = 'progress.txt'  # File to store the last processed batch number
 
+# Adaptive scheduler (--adaptive): points are bucketed into CELL_SIZE_DEG x CELL_SIZE_DEG
+# grid cells. A few probe points per cell are queried first; only cells that showed
+# buildings get every point queried, confirmed-empty cells are sampled every
+# EMPTY_CELL_SAMPLE_EVERY-th point and the rest is deferred to a CSV.
+CELL_SIZE_DEG = 0.01  # ~1 km
+PROBES_PER_CELL = 3
+EMPTY_CELL_SAMPLE_EVERY = 10
+
 ssl_context = ssl.create_default_context()
 ssl_context.set_ciphers('DEFAULT')
 ssl_context.check_hostname = False
 ssl_context.verify_mode = ssl.CERT_NONE
 
+# Per-attempt deadline and hedging (--attempt-timeout, --hedge, --hedge-budget).
+# At most CONNECTION_LIMIT requests are in flight; a request's deadline and latency only
+# start once it holds one of those slots, so rows waiting for a connection never time out.
+# With hedging on, a request still running after the observed HEDGE_PERCENTILE latency
+# gets a duplicate on one of HEDGE_CONNECTIONS reserved connections; the first response
+# wins and the other is cancelled. At most HEDGE_BUDGET extra requests per primary are sent.
+CONNECTION_LIMIT = 100
+HEDGE_CONNECTIONS = 10
+ATTEMPT_TIMEOUT = 30  # seconds per attempt once a connection slot is held; 0 = no deadline
+HEDGE_REQUESTS = False
+HEDGE_BUDGET = 0.1
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 50  # latencies needed before the percentile is trusted
+HEDGE_REFRESH_EVERY = 100  # new latencies between recomputations of the hedge delay
+LATENCY_WINDOW = 2000  # most recent latencies used for the percentile
+
 building_ids = set()
 
+class RequestHedger:
+    """
+    Runs request attempts with a deadline and, if enabled, hedges slow ones.
+    Keeps a sliding window of observed latencies to pick the hedge delay.
+    """
+
+    def __init__(self, attempt_timeout=ATTEMPT_TIMEOUT, enabled=HEDGE_REQUESTS, budget=HEDGE_BUDGET,
+                 percentile=HEDGE_PERCENTILE, window=LATENCY_WINDOW,
+                 connection_limit=CONNECTION_LIMIT, hedge_connections=HEDGE_CONNECTIONS):
+        self.attempt_timeout = attempt_timeout
+        self.enabled = enabled
+        self.budget = budget
+        self.percentile = percentile
+        self.latencies = deque(maxlen=window)
+        self.connection_limit = connection_limit
+        self.slots = None  # created in run(): on Python < 3.10 a Semaphore binds to the loop it is made in
+        self.hedge_connections = hedge_connections
+        self.hedges_in_flight = 0
+        self.primary_count = 0
+        self.hedge_count = 0
+        self.hedge_wins = 0
+        self._delay = None
+        self._samples_since_refresh = 0
+
+    def record(self, latency):
+        self.latencies.append(latency)
+        self._samples_since_refresh += 1
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return
+        if self._delay is None or self._samples_since_refresh >= HEDGE_REFRESH_EVERY:
+            self._delay = self.latency_percentile(self.percentile)
+            self._samples_since_refresh = 0
+
+    def latency_percentile(self, percentile):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        pos = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[pos]
+
+    def hedge_delay(self):
+        """
+        Seconds to wait before hedging, or None if hedging is off or there is no reliable estimate yet.
+        """
+        if not self.enabled:
+            return None
+        return self._delay
+
+    def _take_hedge(self):
+        if self.hedges_in_flight >= self.hedge_connections:
+            return False
+        if self.hedge_count + 1 > self.budget * self.primary_count:
+            return False
+        self.hedge_count += 1
+        return True
+
+    def _hedge_done(self, task):
+        self.hedges_in_flight -= 1
+
+    async def _attempt(self, make_request, primary=True):
+        # Deadline and latency sample both start here, after a connection slot is held.
+        # A primary that times out or is cancelled (its hedge won) is still recorded with
+        # the time it ran, a lower bound of its latency, so slow requests stay in the window.
+        # A cancelled hedge only ran after the hedge delay and would bias the window low.
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            if self.attempt_timeout:
+                result = await asyncio.wait_for(make_request(), self.attempt_timeout)
+            else:
+                result = await make_request()
+        except asyncio.TimeoutError:
+            self.record(self.attempt_timeout)
+            raise
+        except asyncio.CancelledError:
+            if primary:
+                self.record(loop.time() - started)
+            raise
+        self.record(loop.time() - started)
+        return result
+
+    async def run(self, make_request):
+        """
+        Await make_request() once a connection slot is free, hedging it on a reserved
+        connection if it is slower than the hedge delay.
+        Returns the first result; raises only if every issued request failed.
+        """
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.connection_limit)
+        async with self.slots:
+            self.primary_count += 1
+            primary = asyncio.ensure_future(self._attempt(make_request))
+            tasks = [primary]
+            try:
+                delay = self.hedge_delay()
+                if delay is None:
+                    return await primary
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if done or not self._take_hedge():
+                    return await primary
+
+                hedge = asyncio.ensure_future(self._attempt(make_request, primary=False))
+                self.hedges_in_flight += 1
+                hedge.add_done_callback(self._hedge_done)
+                tasks.append(hedge)
+                pending = set(tasks)
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None:
+                            if task is hedge:
+                                self.hedge_wins += 1
+                            return task.result()
+                # Both failed: surface the primary's error
+                return primary.result()
+            finally:
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+
+hedger = RequestHedger()
+
 def load_existing_buildings_ndjson(filename: str):
     """
     Load building IDs (and optionally building data) from an ND-JSON file.
@@ -80,6 +229,77 @@ def extract_buildings(data):
             buildings.append(item)
     return buildings
 
+def parcel_rings(building):
+    """
+    Return the parcel polygon of a building as a list of rings,
+    each ring a list of (lon, lat) tuples.
+    Accepts GeoJSON geometries (Polygon / MultiPolygon) and WKT strings.
+    Returns an empty list if the building has no usable parcel.
+    """
+    parcel = building.get('parcel')
+    if isinstance(parcel, str):
+        rings = []
+        for ring_text in re.findall(r'\(([^()]+)\)', parcel):
+            ring = []
+            for pair in ring_text.split(','):
+                parts = pair.split()
+                if len(parts) < 2:
+                    continue
+                try:
+                    ring.append((float(parts[0]), float(parts[1])))
+                except ValueError:
+                    continue
+            if ring:
+                rings.append(ring)
+        return rings
+
+    if not isinstance(parcel, dict):
+        return []
+    coords = parcel.get('coordinates')
+    if parcel.get('type') == 'Polygon':
+        polygons = [coords]
+    elif parcel.get('type') == 'MultiPolygon':
+        polygons = coords
+    else:
+        return []
+
+    rings = []
+    for polygon in polygons or []:
+        for ring in polygon or []:
+            rings.append([(float(pt[0]), float(pt[1])) for pt in ring if len(pt) >= 2])
+    return [ring for ring in rings if ring]
+
+def parcel_extent(building):
+    """
+    Return the bounding box of a building's parcel as
+    (min_lon, min_lat, max_lon, max_lat), or None if it has no parcel.
+    """
+    points = [pt for ring in parcel_rings(building) for pt in ring]
+    if not points:
+        return None
+    lons = [pt[0] for pt in points]
+    lats = [pt[1] for pt in points]
+    return (min(lons), min(lats), max(lons), max(lats))
+
+def cell_of(lat, lon):
+    """
+    Grid cell key (row, col) for a coordinate, using CELL_SIZE_DEG.
+    """
+    return (math.floor(lat / CELL_SIZE_DEG), math.floor(lon / CELL_SIZE_DEG))
+
+def cells_in_extent(extent):
+    """
+    All grid cells overlapped by a (min_lon, min_lat, max_lon, max_lat) box.
+    """
+    min_lon, min_lat, max_lon, max_lat = extent
+    row_min, col_min = cell_of(min_lat, min_lon)
+    row_max, col_max = cell_of(max_lat, max_lon)
+    return [
+        (row, col)
+        for row in range(row_min, row_max + 1)
+        for col in range(col_min, col_max + 1)
+    ]
+
 async def fetch_building_data(session, index, lat, lon, lock):
     """
     Fetch building data for a single (lat, lon).
@@ -92,42 +312,53 @@ async def fetch_building_data(session, index, lat, lon, lock):
     }
     url = 'https://gnaf2.post.ir/post-services/buildings?' + urlencode(params)
 
+    async def request():
+        # One attempt: (status, parsed JSON or None, JSON decode error or None)
+        async with session.get(url, headers=HEADERS) as response:
+            data, json_error = None, None
+            if response.status == 200:
+                try:
+                    data = await response.json()
+                except json.JSONDecodeError as e:
+                    json_error = e
+        return response.status, data, json_error
+
     for attempt in range(3):
         try:
-            async with session.get(url, headers=HEADERS) as response:
-                if response.status == 200:
-                    try:
-                        data = await response.json()
-                        buildings = extract_buildings(data)
-                        if not buildings:
-                            # We consider it a successful call but no buildings found
-                            return (index, True, "No buildings found", [])
-                        new_buildings = []
-                        async with lock:
-                            for bld in buildings:
-                                b_id = bld.get('id')
-                                if b_id and (b_id not in building_ids):
-                                    new_buildings.append(bld)
-                                    building_ids.add(b_id)
-                        return (index, True, None, new_buildings)
-                    except json.JSONDecodeError as json_error:
-                        return (index, False, f"JSON decode error: {json_error}", [])
-                elif response.status == 404:
-                    return (index, False, "404 Not Found", [])
-                else:
-                    return (index, False, f"Non-200 response: Status {response.status}", [])
-        except Exception as e:
-            # You can optionally log the exception e here
-            pass
+            status, data, json_error = await hedger.run(request)
+        except Exception:
+            # Timeouts and connection errors: try again
+            continue
+
+        if status == 200:
+            if json_error is not None:
+                return (index, False, f"JSON decode error: {json_error}", [])
+            buildings = extract_buildings(data)
+            if not buildings:
+                # We consider it a successful call but no buildings found
+                return (index, True, "No buildings found", [])
+            new_buildings = []
+            async with lock:
+                for bld in buildings:
+                    b_id = bld.get('id')
+                    if b_id and (b_id not in building_ids):
+                        new_buildings.append(bld)
+                        building_ids.add(b_id)
+            return (index, True, None, new_buildings)
+        elif status == 404:
+            return (index, False, "404 Not Found", [])
+        else:
+            return (index, False, f"Non-200 response: Status {status}", [])
 
     # If we exhausted all attempts
     return (index, False, "All attempts failed after local retries", [])
 
 from tqdm.asyncio import tqdm
 
-async def process_batch(df_chunk, session, lock, fail_counts, batch_number, pass_number):
+async def process_batch(df_chunk, session, lock, fail_counts, batch_number, pass_number, results=None):
     """
     Process one pass of the given df_chunk. Creates and runs tasks for each row in the chunk.
+    If a `results` dict is given, it is filled with idx -> (success, reason, new_buildings).
 
     Returns:
       - next_df_chunk: A filtered df_chunk that excludes rows that succeeded or are permanently failed
@@ -167,6 +398,8 @@ async def process_batch(df_chunk, session, lock, fail_counts, batch_number, pass
     desc_str = f"Batch#{batch_number} Pass#{pass_number} - Processing"
     for coro in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=desc_str):
         idx, success, reason, buildings = await coro
+        if results is not None:
+            results[idx] = (success, reason, buildings)
 
         if success:
             successes += 1
@@ -209,11 +442,182 @@ async def process_batch(df_chunk, session, lock, fail_counts, batch_number, pass
 
     return next_df_chunk, total_attempts, successes, zero_build_count, new_bld_count, failures
 
+async def process_batch_adaptive(df_chunk, session, lock, fail_counts, batch_number, pass_number):
+    """
+    Coarse-to-fine version of process_batch for sparse regions.
+
+    1) Query up to PROBES_PER_CELL evenly spaced points of every grid cell.
+    2) Cells where a probe found buildings, or that are overlapped by a returned parcel
+       extent, get all their points queried. Confirmed-empty cells are sampled every
+       EMPTY_CELL_SAMPLE_EVERY-th point.
+    3) Empty cells whose samples found buildings are promoted and queried fully.
+
+    A failed probe or sample is re-queried once on another point of the same cell; only a
+    cell that still can't be confirmed is treated as unknown and queried fully.
 
-async def main(start_batch):
+    Points never queried are written to deferred_points_batch{N}_pass{M}.csv and the
+    per-cell coverage to cell_coverage_batch{N}_pass{M}.csv.
+    Returns the same tuple as process_batch; deferred rows are not part of next_df_chunk.
+    """
+    if 'Lat' not in df_chunk.columns or 'Long' not in df_chunk.columns:
+        return await process_batch(df_chunk, session, lock, fail_counts, batch_number, pass_number)
+
+    lats = pd.to_numeric(df_chunk['Lat'], errors='coerce')
+    lons = pd.to_numeric(df_chunk['Long'], errors='coerce')
+
+    # Bucket the rows into grid cells, keeping file order inside each cell
+    cell_points = {}
+    unplaced = []
+    for idx, lat, lon in zip(df_chunk.index, lats, lons):
+        if pd.isna(lat) or pd.isna(lon):
+            unplaced.append(idx)
+            continue
+        cell_points.setdefault(cell_of(lat, lon), []).append(idx)
+
+    results = {}
+    remaining_chunks = []
+    totals = [0, 0, 0, 0, 0]  # attempts, successes, zero buildings, new buildings, failures
+
+    async def run(indices, label):
+        if not indices:
+            return
+        next_chunk, *stats = await process_batch(
+            df_chunk.loc[indices], session, lock, fail_counts,
+            batch_number, f"{pass_number}{label}", results
+        )
+        remaining_chunks.append(next_chunk)
+        for i, value in enumerate(stats):
+            totals[i] += value
+
+    def found_buildings(idx):
+        success, reason, _ = results[idx]
+        return success and reason is None
+
+    def failed_cells(indices):
+        return {idx_cell[idx] for idx in indices
+                if idx in idx_cell and idx in results and not results[idx][0]}
+
+    def cells_with_buildings(indices):
+        cells = set()
+        for idx in indices:
+            if idx not in results:
+                continue
+            if found_buildings(idx) and idx in idx_cell:
+                cells.add(idx_cell[idx])
+            for bld in results[idx][2]:
+                extent = parcel_extent(bld)
+                if extent:
+                    cells.update(c for c in cells_in_extent(extent) if c in cell_points)
+        return cells
+
+    async def requery_failures(indices, label, settled_cells):
+        # Re-query each failed point of a cell not yet known to have buildings, on an
+        # unqueried point of the same cell when one is left. Returns the re-queried points
+        # and the cells that still could not be confirmed.
+        retry, chosen = [], set()
+        for idx in indices:
+            if idx not in idx_cell or results[idx][0] or idx_cell[idx] in settled_cells:
+                continue
+            spare = next(
+                (i for i in cell_points[idx_cell[idx]] if i not in results and i not in chosen),
+                idx
+            )
+            if spare not in chosen:
+                chosen.add(spare)
+                retry.append(spare)
+        await run(retry, label)
+        return retry, failed_cells(retry) - cells_with_buildings(retry)
+
+    idx_cell = {idx: cell for cell, indices in cell_points.items() for idx in indices}
+
+    # 1) Sparse lattice: a few evenly spaced probes per cell
+    probe_indices = []
+    for indices in cell_points.values():
+        n = len(indices)
+        k = min(PROBES_PER_CELL, n)
+        probe_indices.extend(indices[(i * n) // k] for i in range(k))
+    await run(probe_indices + unplaced, "a")
+
+    # 2) Learn which cells have buildings; cells whose failed probes fail again are unknown -> dense
+    hot_cells = cells_with_buildings(probe_indices)
+    retried, unconfirmed_cells = await requery_failures(probe_indices, "a2", hot_cells)
+    hot_cells |= cells_with_buildings(retried) | unconfirmed_cells
+
+    dense, sampled = [], []
+    for cell, indices in cell_points.items():
+        rest = [idx for idx in indices if idx not in results]
+        if cell in hot_cells:
+            dense.extend(rest)
+        else:
+            sampled.extend(rest[::EMPTY_CELL_SAMPLE_EVERY])
+    await run(dense + sampled, "b")
+
+    # 3) Promote "empty" cells where the samples hit buildings or can't be confirmed
+    promoted = cells_with_buildings(sampled + dense) - hot_cells
+    retried, unconfirmed = await requery_failures(sampled, "b2", hot_cells | promoted)
+    promoted |= (cells_with_buildings(retried) | unconfirmed) - hot_cells
+    unconfirmed_cells |= unconfirmed
+    hot_cells |= promoted
+    await run(
+        [idx for cell in promoted for idx in cell_points[cell] if idx not in results],
+        "c"
+    )
+
+    # Per-cell coverage report and deferred points.
+    # 'unknown' = no buildings seen and failures persisted after re-querying
+    building_cells = cells_with_buildings(list(results))
+    unknown_cells = unconfirmed_cells - building_cells
+    cell_digits = max(0, -math.floor(math.log10(CELL_SIZE_DEG)))
+    coverage_rows = []
+    deferred_indices = []
+    for (row, col), indices in cell_points.items():
+        queried = [idx for idx in indices if idx in results]
+        deferred = [idx for idx in indices if idx not in results]
+        deferred_indices.extend(deferred)
+        coverage_rows.append({
+            'Cell Lat': round(row * CELL_SIZE_DEG, cell_digits),
+            'Cell Long': round(col * CELL_SIZE_DEG, cell_digits),
+            'State': (
+                'buildings' if (row, col) in building_cells
+                else 'unknown' if (row, col) in unknown_cells
+                else 'empty'
+            ),
+            'Points': len(indices),
+            'Queried': len(queried),
+            'With Buildings': sum(1 for idx in queried if found_buildings(idx)),
+            'Failed': sum(1 for idx in queried if not results[idx][0]),
+            'Deferred': len(deferred),
+            'Coverage': len(queried) / len(indices),
+        })
+
+    coverage_file = f"cell_coverage_batch{batch_number}_pass{pass_number}.csv"
+    pd.DataFrame(coverage_rows).to_csv(coverage_file, index=False)
+    if deferred_indices:
+        deferred_file = f"deferred_points_batch{batch_number}_pass{pass_number}.csv"
+        df_chunk.loc[deferred_indices].to_csv(deferred_file, index=False)
+        print(f"Deferred {len(deferred_indices)} points in empty cells to {deferred_file}")
+
+    empty_cells = len(cell_points) - len(building_cells) - len(unknown_cells)
+    print(f"Batch#{batch_number} Pass#{pass_number} Cells: {len(building_cells)} with buildings, "
+          f"{len(unknown_cells)} unknown, {empty_cells} empty (coverage in {coverage_file})")
+
+    if remaining_chunks:
+        next_df_chunk = pd.concat(remaining_chunks)
+    else:
+        next_df_chunk = df_chunk.iloc[0:0]
+    return (next_df_chunk, *totals)
+
+
+async def main(start_batch, adaptive=False, attempt_timeout=ATTEMPT_TIMEOUT, hedge=HEDGE_REQUESTS,
+               hedge_budget=HEDGE_BUDGET):
     # 1) Load building IDs from ND-JSON to avoid duplicates
-    global building_ids
+    global building_ids, hedger
     building_ids = load_existing_buildings_ndjson(NDJSON_FILENAME)
+    hedger = RequestHedger(attempt_timeout=attempt_timeout, enabled=hedge, budget=hedge_budget)
+
+    # The connector has room for every primary slot plus the reserved hedge connections,
+    # so neither ever waits in aiohttp's pool
+    connection_limit = CONNECTION_LIMIT + (HEDGE_CONNECTIONS if hedge else 0)
 
     # We'll track how many total zero-building calls we get for info
     total_zero_buildings = 0
@@ -222,7 +626,7 @@ async def main(start_batch):
     fail_counts = {}
 
     # Set up aiohttp session
-    connector = aiohttp.TCPConnector(limit=100, ssl=ssl_context)
+    connector = aiohttp.TCPConnector(limit=connection_limit, ssl=ssl_context)
     async with aiohttp.ClientSession(connector=connector) as session:
         lock = asyncio.Lock()
 
@@ -253,7 +657,7 @@ async def main(start_batch):
                     zero_build_count,
                     new_bld_count,
                     failures
-                ) = await process_batch(
+                ) = await (process_batch_adaptive if adaptive else process_batch)(
                     df_chunk, session, lock, fail_counts,
                     batch_number, pass_num
                 )
@@ -286,6 +690,13 @@ async def main(start_batch):
         print(f"Total unique building IDs in memory: {len(building_ids)}")
         print(f"Total calls that returned 0 buildings: {total_zero_buildings}")
         print(f"Total permanently failed rows: {len(permanently_failed)}")
+        p50 = hedger.latency_percentile(50)
+        p95 = hedger.latency_percentile(95)
+        if p50 is not None:
+            print(f"Request latency: p50 = {p50:.2f}s, p95 = {p95:.2f}s")
+        if hedge:
+            print(f"Hedged requests: {hedger.hedge_count} of {hedger.primary_count} "
+                  f"({hedger.hedge_wins} hedges answered first)")
 
         # Optional: Let the user retry permanently_failed rows from scratch
         if permanently_failed:
@@ -351,6 +762,14 @@ async def main(start_batch):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Process building data with batch resume capability.")
     parser.add_argument('--start-batch', type=int, default=1, help='Batch number to start processing from.')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Probe a sparse grid first and skip/sample points in cells with no buildings.')
+    parser.add_argument('--attempt-timeout', type=float, default=ATTEMPT_TIMEOUT,
+                        help='Deadline in seconds for each request attempt once it holds a connection (0 = none).')
+    parser.add_argument('--hedge', action='store_true',
+                        help=f'Send a duplicate request when one exceeds the observed p{HEDGE_PERCENTILE} latency.')
+    parser.add_argument('--hedge-budget', type=float, default=HEDGE_BUDGET,
+                        help='Maximum extra hedged requests as a fraction of all requests.')
     args = parser.parse_args()
 
     # Check if there's a progress file and set start_batch accordingly if not provided
@@ -361,4 +780,10 @@ if __name__ == '__main__':
                 args.start_batch = int(last_batch) + 1
                 print(f"Resuming from batch #{args.start_batch} based on progress file.")
 
-    asyncio.run(main(start_batch=args.start_batch))
+    asyncio.run(main(
+        start_batch=args.start_batch,
+        adaptive=args.adaptive,
+        attempt_timeout=args.attempt_timeout,
+        hedge=args.hedge,
+        hedge_budget=args.hedge_budget
+    ))
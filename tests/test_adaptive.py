@@ -0,0 +1,144 @@
+import asyncio
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+EMPTY = "No buildings found"
+
+
+def square(lon, lat, size):
+    ring = [[lon, lat], [lon + size, lat], [lon + size, lat + size], [lon, lat + size], [lon, lat]]
+    return {'type': 'Polygon', 'coordinates': [ring]}
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # process_batch_adaptive writes its CSVs to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def run_adaptive(monkeypatch, df, answer):
+    """
+    Run process_batch_adaptive with fetch_building_data stubbed by answer(idx, lat, lon, call),
+    which returns (success, reason, buildings). Returns (result tuple, queried idx -> call count).
+    """
+    calls = {}
+
+    async def fake_fetch(session, index, lat, lon, lock):
+        call = calls.get(index, 0)
+        calls[index] = call + 1
+        return (index, *answer(index, lat, lon, call))
+
+    monkeypatch.setattr(main, 'fetch_building_data', fake_fetch)
+    result = asyncio.run(main.process_batch_adaptive(df, None, None, {}, 1, 1))
+    return result, calls
+
+
+def coverage():
+    return pd.read_csv('cell_coverage_batch1_pass1.csv').set_index(['Cell Lat', 'Cell Long'])
+
+
+def cell_rows(lat, lon, n):
+    # n points inside the grid cell whose corner is (lat, lon)
+    step = main.CELL_SIZE_DEG / (n + 1)
+    return [{'Lat': lat + step * (i + 1) / 2, 'Long': lon + step * (i + 1)} for i in range(n)]
+
+
+def test_empty_cells_are_sampled_and_the_rest_deferred(workdir, monkeypatch):
+    df = pd.DataFrame(cell_rows(35.20, 51.00, 40) + cell_rows(35.20, 51.01, 40))
+    result, calls = run_adaptive(monkeypatch, df, lambda idx, lat, lon, call: (True, EMPTY, []))
+
+    # Only a few probes per cell plus one point in EMPTY_CELL_SAMPLE_EVERY
+    rest = 40 - main.PROBES_PER_CELL
+    per_cell = main.PROBES_PER_CELL + len(range(0, rest, main.EMPTY_CELL_SAMPLE_EVERY))
+    assert len(calls) == 2 * per_cell
+    assert result[0].empty
+
+    deferred = pd.read_csv('deferred_points_batch1_pass1.csv')
+    never_queried = df.drop(index=list(calls))
+    pd.testing.assert_frame_equal(deferred, never_queried.reset_index(drop=True))
+
+    cov = coverage()
+    assert (cov['State'] == 'empty').all()
+    assert cov['Deferred'].sum() == len(never_queried)
+    assert list(cov.index) == [(35.2, 51.0), (35.2, 51.01)]
+
+
+def test_cell_with_buildings_in_one_sample_is_promoted(workdir, monkeypatch):
+    df = pd.DataFrame(cell_rows(35.20, 51.00, 40))
+    # Probes are rows 0, 13 and 26; the remaining rows are sampled from 1, 11, 21, ...
+    sample = 11
+
+    def answer(idx, lat, lon, call):
+        if idx == sample:
+            return True, None, [{'id': idx}]
+        return True, EMPTY, []
+
+    result, calls = run_adaptive(monkeypatch, df, answer)
+    assert len(calls) == len(df)
+    assert not os.path.exists('deferred_points_batch1_pass1.csv')
+    cov = coverage()
+    assert cov['State'].tolist() == ['buildings']
+    assert cov['With Buildings'].tolist() == [1]
+
+
+def test_parcel_extent_promotes_neighbouring_cell(workdir, monkeypatch):
+    df = pd.DataFrame(cell_rows(35.20, 51.00, 20) + cell_rows(35.20, 51.01, 20))
+
+    def answer(idx, lat, lon, call):
+        if lon < 51.01:
+            # A parcel reaching across the cell border into the next cell
+            return True, None, [{'id': idx, 'parcel': square(51.009, 35.201, 0.002)}]
+        return True, EMPTY, []
+
+    result, calls = run_adaptive(monkeypatch, df, answer)
+    assert len(calls) == len(df)
+    cov = coverage()
+    assert cov.loc[(35.2, 51.01), 'State'] == 'buildings'
+    assert cov.loc[(35.2, 51.01), 'With Buildings'] == 0
+
+
+def test_transient_failure_is_requeried_not_promoted(workdir, monkeypatch):
+    df = pd.DataFrame(cell_rows(35.20, 51.00, 40))
+
+    def answer(idx, lat, lon, call):
+        if idx == 0 and call == 0:
+            return False, "Non-200 response: Status 500", []
+        return True, EMPTY, []
+
+    result, calls = run_adaptive(monkeypatch, df, answer)
+    assert len(calls) < len(df)
+    assert coverage()['State'].tolist() == ['empty']
+    # The failed probe stays in next_df_chunk for the next pass
+    assert result[0].index.tolist() == [0]
+
+
+def test_persistent_failures_mark_cell_unknown(workdir, monkeypatch):
+    df = pd.DataFrame(cell_rows(35.20, 51.00, 40))
+
+    def answer(idx, lat, lon, call):
+        if idx in (0, 1, 2, 3):
+            return False, "Non-200 response: Status 500", []
+        return True, EMPTY, []
+
+    result, calls = run_adaptive(monkeypatch, df, answer)
+    assert len(calls) == len(df)
+    assert coverage()['State'].tolist() == ['unknown']
+
+
+def test_nan_coordinates_are_queried_outside_the_grid(workdir, monkeypatch):
+    df = pd.DataFrame(cell_rows(35.20, 51.00, 10) + [{'Lat': None, 'Long': 51.0}])
+    result, calls = run_adaptive(monkeypatch, df, lambda idx, lat, lon, call: (True, EMPTY, []))
+
+    assert 10 in calls
+    cov = coverage()
+    assert cov['Points'].sum() == 10
+    deferred = pd.read_csv('deferred_points_batch1_pass1.csv')
+    assert deferred['Lat'].notna().all()
@@ -0,0 +1,131 @@
+import asyncio
+import math
+import os
+import random
+import sys
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import RequestHedger
+
+
+def make_server(delays):
+    """
+    Test server answering /row/{n}. delays(n, call) gives the seconds to wait
+    before answering the call-th request (0-based) for row n.
+    """
+    calls = {}
+
+    async def handler(request):
+        n = int(request.match_info['n'])
+        call = calls.get(n, 0)
+        calls[n] = call + 1
+        await asyncio.sleep(delays(n, call))
+        return web.json_response({'row': n, 'call': call})
+
+    app = web.Application()
+    app.router.add_get('/row/{n}', handler)
+    return TestServer(app)
+
+
+async def run_rows(hedger, delays, rows, connection_limit):
+    cancelled = []
+
+    async with make_server(delays) as server:
+        connector = aiohttp.TCPConnector(limit=connection_limit)
+        async with aiohttp.ClientSession(connector=connector) as session:
+
+            async def fetch(n):
+                async def request():
+                    try:
+                        async with session.get(server.make_url(f'/row/{n}')) as response:
+                            return await response.json()
+                    except asyncio.CancelledError:
+                        cancelled.append(n)
+                        raise
+
+                try:
+                    return await hedger.run(request)
+                except asyncio.TimeoutError:
+                    return None
+
+            results = await asyncio.gather(*(fetch(n) for n in range(rows)))
+    return results, cancelled
+
+
+def test_deadline_ignores_time_waiting_for_a_connection():
+    # 40 rows through 2 connections take ~1 s in total, far longer than the 0.3 s deadline
+    hedger = RequestHedger(attempt_timeout=0.3, connection_limit=2)
+    results, _ = asyncio.run(run_rows(hedger, lambda n, call: 0.05, rows=40, connection_limit=2))
+    assert all(result is not None for result in results)
+
+
+def test_steady_server_is_not_hedged():
+    hedger = RequestHedger(enabled=True, budget=1.0, connection_limit=2, hedge_connections=2)
+    for i in range(60):
+        hedger.record(0.05 + i * 0.001)
+
+    results, _ = asyncio.run(run_rows(hedger, lambda n, call: 0.05, rows=40, connection_limit=4))
+    assert all(result is not None for result in results)
+    assert hedger.hedge_count == 0
+
+
+def test_slow_row_is_won_by_hedge_and_loser_cancelled():
+    hedger = RequestHedger(enabled=True, budget=1.0, connection_limit=4, hedge_connections=2)
+    for _ in range(60):
+        hedger.record(0.05)
+
+    # Row 0 stalls on its first request only
+    def delays(n, call):
+        return 5.0 if (n == 0 and call == 0) else 0.05
+
+    loop_time = []
+
+    async def timed():
+        started = asyncio.get_running_loop().time()
+        outcome = await run_rows(hedger, delays, rows=8, connection_limit=6)
+        loop_time.append(asyncio.get_running_loop().time() - started)
+        return outcome
+
+    results, cancelled = asyncio.run(timed())
+    assert results[0] == {'row': 0, 'call': 1}
+    assert hedger.hedge_wins >= 1
+    assert 0 in cancelled
+    assert loop_time[0] < 2.0
+
+
+def test_hedges_respect_budget():
+    hedger = RequestHedger(enabled=True, budget=0.1, connection_limit=4, hedge_connections=4)
+    for _ in range(60):
+        hedger.record(0.01)
+
+    # Every first request is slower than p95, so each row would be hedged without a budget
+    def delays(n, call):
+        return 0.1 if call == 0 else 0.01
+
+    results, _ = asyncio.run(run_rows(hedger, delays, rows=40, connection_limit=8))
+    assert all(result is not None for result in results)
+    assert 0 < hedger.hedge_count <= 0.1 * hedger.primary_count
+
+
+def test_hedge_delay_stays_near_true_p95_when_hedges_win():
+    # Lognormal latencies: median 20 ms, true p95 = exp(mu + 1.645 sigma) ~ 54 ms
+    mu, sigma = math.log(0.02), 0.6
+    true_p95 = math.exp(mu + 1.6449 * sigma)
+    hedger = RequestHedger(enabled=True, budget=1.0, connection_limit=50, hedge_connections=50, window=100_000)
+    rnd = random.Random(1)
+
+    async def request():
+        await asyncio.sleep(rnd.lognormvariate(mu, sigma))
+
+    async def run_all():
+        await asyncio.gather(*(hedger.run(request) for _ in range(3000)))
+
+    asyncio.run(run_all())
+    assert hedger.hedge_wins > 0
+    # Without recording the cancelled primaries the delay drifts down to about p92
+    assert abs(hedger.hedge_delay() / true_p95 - 1) < 0.07
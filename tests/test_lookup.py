@@ -0,0 +1,175 @@
+import asyncio
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lookup
+from main import parcel_rings
+
+
+def ring(x0, y0, x1, y1, closed=True):
+    pts = [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+    return pts + [pts[0]] if closed else pts
+
+
+def wkt_ring(pts):
+    return '(' + ', '.join(f'{x} {y}' for x, y in pts) + ')'
+
+
+BUILDINGS = [
+    # Square with a square hole
+    {'id': 1, 'parcel': {'type': 'Polygon', 'coordinates': [ring(0, 0, 10, 10), ring(4, 4, 6, 6)]}},
+    # Two separate squares
+    {'id': 2, 'parcel': {'type': 'MultiPolygon', 'coordinates': [[ring(20, 0, 22, 2)], [ring(30, 0, 32, 2)]]}},
+    # WKT with an SRID prefix
+    {'id': 3, 'parcel': 'SRID=4326;POLYGON(' + wkt_ring(ring(40, 0, 42, 2)) + ')'},
+    # WKT multipolygon
+    {'id': 4, 'parcel': 'MULTIPOLYGON((' + wkt_ring(ring(50, 0, 52, 2)) + '),(' + wkt_ring(ring(60, 0, 62, 2)) + '))'},
+    # Unclosed ring
+    {'id': 5, 'parcel': {'type': 'Polygon', 'coordinates': [ring(70, 0, 72, 2, closed=False)]}},
+    # Second building on the same parcel as id 3
+    {'id': 6, 'parcel': 'POLYGON(' + wkt_ring(ring(40, 0, 42, 2)) + ')', 'name': 'ساختمان'},
+    # No parcel: skipped
+    {'id': 7, 'parcel': None},
+]
+
+
+@pytest.fixture
+def index():
+    return lookup.BuildingIndex.build(BUILDINGS, cell_deg=1.0)
+
+
+def contains(idx, lon, lat):
+    return sorted(idx.lookup_ids([lat], [lon])[0])
+
+
+def test_parcel_rings_formats():
+    assert parcel_rings(BUILDINGS[0]) == [
+        [tuple(pt) for pt in ring(0, 0, 10, 10)], [tuple(pt) for pt in ring(4, 4, 6, 6)]
+    ]
+    assert len(parcel_rings(BUILDINGS[1])) == 2
+    assert parcel_rings(BUILDINGS[2]) == [[tuple(map(float, pt)) for pt in ring(40, 0, 42, 2)]]
+    assert len(parcel_rings(BUILDINGS[3])) == 2
+    assert parcel_rings(BUILDINGS[6]) == []
+    assert parcel_rings({'id': 8, 'parcel': {'type': 'Point', 'coordinates': [1, 2]}}) == []
+
+
+def test_point_in_polygon(index):
+    assert len(index) == 6
+    assert contains(index, 1, 1) == ['1']
+    assert contains(index, 5, 5) == []  # inside the hole
+    assert contains(index, 21, 1) == ['2']
+    assert contains(index, 31, 1) == ['2']
+    assert contains(index, 25, 1) == []
+    assert contains(index, 41, 1) == ['3', '6']
+    assert contains(index, 61, 1) == ['4']
+    assert contains(index, 71, 1) == ['5']
+    assert contains(index, 100, 100) == []
+    assert index.lookup_ids([np.nan], [1.0]) == [[]]
+
+
+def test_vectorized_query_matches_scalar_ray_casting():
+    rng = np.random.default_rng(0)
+    buildings = []
+    for i in range(300):
+        cx, cy = rng.random(2) * 0.05
+        angles = np.sort(rng.random(6) * 2 * np.pi)
+        radii = 0.002 * (0.5 + rng.random(6))
+        pts = [[cx + r * np.cos(a), cy + r * np.sin(a)] for r, a in zip(radii, angles)]
+        buildings.append({'id': i, 'parcel': {'type': 'Polygon', 'coordinates': [pts + [pts[0]]]}})
+    idx = lookup.BuildingIndex.build(buildings, cell_deg=0.001)
+
+    def inside(x, y, pts):
+        result = False
+        for (x0, y0), (x1, y1) in zip(pts, pts[1:]):
+            if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+                result = not result
+        return result
+
+    lats, lons = rng.random(1000) * 0.05, rng.random(1000) * 0.05
+    got = idx.lookup_ids(lats, lons)
+    matches = 0
+    for k in range(len(lats)):
+        expected = sorted(
+            str(b['id']) for b in buildings if inside(lons[k], lats[k], b['parcel']['coordinates'][0])
+        )
+        assert sorted(got[k]) == expected
+        matches += bool(expected)
+    assert matches > 50
+
+
+def test_save_load_round_trip(index, tmp_path):
+    filename = str(tmp_path / 'index.npz')
+    index.save(filename)
+    loaded = lookup.BuildingIndex.load(filename)
+
+    lats, lons = [1, 5, 1, 1], [1, 5, 41, 71]
+    assert loaded.lookup_ids(lats, lons) == index.lookup_ids(lats, lons)
+    assert [loaded.building_json(pos) for pos in range(len(loaded))] == \
+        [index.building_json(pos) for pos in range(len(index))]
+    assert json.loads(loaded.building_json(5)) == BUILDINGS[5]
+
+
+def test_get_index_without_harvest(index, tmp_path):
+    filename = str(tmp_path / 'index.npz')
+    missing_source = str(tmp_path / 'missing.txt')
+    with pytest.raises(FileNotFoundError):
+        lookup.get_index(missing_source, filename)
+
+    index.save(filename)
+    assert lookup.get_index(missing_source, filename).lookup_ids([1], [1]) == [['1']]
+
+
+def test_get_index_builds_from_harvest(tmp_path):
+    # Parcel-sized polygons, since the default grid has ~100 m cells
+    buildings = [
+        {'id': 1, 'parcel': {'type': 'Polygon', 'coordinates': [ring(51.0, 35.0, 51.0005, 35.0005)]}},
+        {'id': 2, 'parcel': None},
+    ]
+    source = tmp_path / 'buildings.txt'
+    # Duplicate and invalid lines are skipped
+    source.write_text(
+        ''.join(json.dumps(b) + '\n' for b in buildings + buildings[:1]) + 'not json\n', encoding='utf-8'
+    )
+    filename = str(tmp_path / 'index.npz')
+    idx = lookup.get_index(str(source), filename)
+    assert idx.ids.tolist() == ['1']
+    assert os.path.exists(filename)
+    assert idx.lookup_ids([35.0002], [51.0002]) == [['1']]
+
+
+def test_endpoint(index):
+    async def check():
+        async with TestClient(TestServer(lookup.make_app(index))) as client:
+            async def get(**params):
+                response = await client.get('/post-services/buildings', params=params)
+                return response.status, await response.json()
+
+            status, body = await get(**{'$top': '20', '$filter': 'contains(parcel, POINT(41 1))'})
+            assert status == 200
+            assert body['value'] == [BUILDINGS[2], BUILDINGS[5]]
+
+            status, body = await get(**{'$top': '1', '$filter': 'contains(parcel, POINT(41 1))'})
+            assert [b['id'] for b in body['value']] == [3]
+
+            status, body = await get(**{'$filter': 'contains(parcel, POINT(5 5))'})
+            assert (status, body) == (200, {'value': []})
+
+            for params in (
+                {'$filter': 'name eq 1'},
+                {'$filter': 'contains(parcel, POINT(e e))'},
+                {'$filter': 'contains(parcel, POINT(1..5 0.5))'},
+                {'$top': '-1', '$filter': 'contains(parcel, POINT(1 1))'},
+                {'$top': 'x', '$filter': 'contains(parcel, POINT(1 1))'},
+            ):
+                status, body = await get(**params)
+                assert status == 400, params
+                assert 'error' in body
+
+    asyncio.run(check())